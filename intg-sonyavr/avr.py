@@ -46,14 +46,23 @@ class Events(IntEnum):
     DISCONNECTED = 2
     ERROR = 3
     UPDATE = 4
+    FULL_REFRESH = 5
     # IP_ADDRESS_CHANGED = 6
 
 
-SONY_PLAYBACK_STATE_MAPPING = {
+class _StateMap(dict):
+    """Playback state mapping returning None for unknown or missing states."""
+
+    def __missing__(self, key):
+        return None
+
+
+SONY_PLAYBACK_STATE_MAPPING = _StateMap({
     "STOPPED": States.ON,
     "PLAYING": States.PLAYING,
     "PAUSED": States.PAUSED,
-}
+})
+_PLAYBACK_STATE_OF = SONY_PLAYBACK_STATE_MAPPING.__getitem__
 
 async def retry_call_command(timeout: float, bufferize: bool, func: Callable[Concatenate[_SonyDeviceT, _P], Awaitable[ucapi.StatusCodes | None]],
                  obj: _SonyDeviceT, *args: _P.args, **kwargs: _P.kwargs) -> ucapi.StatusCodes:
@@ -169,6 +178,11 @@ class SonyDevice:
         self._attr_is_volume_muted = False
         self._active_source = None
         self._sources = {}
+        # index of the input sources by title for source selection
+        self._sources_by_title = {}
+        # source and sound mode titles, replaced only when they change so unchanged lists keep their identity
+        self._source_list: list[str] = []
+        self._sound_mode_list: list[str] = []
         self._powered = False
         self._playback_state = States.UNKNOWN
         self._state = States.UNKNOWN
@@ -308,8 +322,9 @@ class SonyDevice:
             _LOG.debug("Sony AVR Source changed: %s", content)
             self._play_info = [content]
             updated_data = {}
-            if content.state and SONY_PLAYBACK_STATE_MAPPING.get(content.state, None):
-                self._playback_state = SONY_PLAYBACK_STATE_MAPPING.get(content.state)
+            playback_state = _PLAYBACK_STATE_OF(content.state)
+            if playback_state:
+                self._playback_state = playback_state
                 if self.update_state():
                     updated_data[MediaAttr.STATE] = self.state
 
@@ -399,9 +414,13 @@ class SonyDevice:
             await self._connect_lock.acquire()
             self._connecting = True
             await self._receiver.get_supported_methods()
-            if self._interface_info is None:
+            if self._interface_info is None and self._sysinfo is None:
+                self._interface_info, self._sysinfo = await asyncio.gather(
+                    self._receiver.get_interface_information(), self._receiver.get_system_info()
+                )
+            elif self._interface_info is None:
                 self._interface_info = await self._receiver.get_interface_information()
-            if self._sysinfo is None:
+            elif self._sysinfo is None:
                 self._sysinfo = await self._receiver.get_system_info()
 
             self._unique_id = self._sysinfo.serialNumber
@@ -411,10 +430,14 @@ class SonyDevice:
                 self._unique_id = self._sysinfo.wirelessMacAddr
 
             settings = await self._receiver.get_sound_settings("soundField")
-            if settings and len(settings) > 0:
+            if settings:
                 self._sound_fields = settings[0]
+                sound_mode_list = [opt.title for opt in self._sound_fields.candidate]
             else:
                 self._sound_fields = None
+                sound_mode_list = []
+            if sound_mode_list != self._sound_mode_list:
+                self._sound_mode_list = sound_mode_list
 
             volumes = await self._receiver.get_volume_information()
             if not volumes:
@@ -440,10 +463,16 @@ class SonyDevice:
             _LOG.debug("Got ins: %s", inputs)
 
             self._sources = OrderedDict()
+            self._sources_by_title = {}
             for input_ in inputs:
                 self._sources[input_.uri] = input_
+                # keep the first input of duplicated titles, as the previous linear search did
+                self._sources_by_title.setdefault(input_.title, input_)
                 if input_.active:
                     self._active_source = input_
+            source_list = [src.title for src in self._sources.values()]
+            if source_list != self._source_list:
+                self._source_list = source_list
 
             _LOG.debug("Active source: %s", self._active_source)
             self._play_info = await self._receiver.get_play_info()
@@ -499,9 +528,9 @@ class SonyDevice:
         # adjust to the real volume level
         # self._expected_volume = self.volume_level
 
-        # None update object means data are up to date & client can fetch required data.
+        # Full refresh means data are up to date & client can fetch required data.
         #TODO : improve send only modified data
-        self.events.emit(Events.UPDATE, self.id, None)
+        self.events.emit(Events.FULL_REFRESH, self.id)
 
     @property
     def unique_id(self) -> str:
@@ -596,7 +625,7 @@ class SonyDevice:
     @property
     def source_list(self) -> list[str]:
         """Return a list of available input sources."""
-        return [src.title for src in self._sources.values()]
+        return self._source_list
 
     @property
     def source(self) -> str:
@@ -616,12 +645,7 @@ class SonyDevice:
     @property
     def sound_mode_list(self) -> list[str]:
         """Return the available sound modes."""
-        if self._sound_fields is None:
-            return []
-        sound_fields: list[str] = []
-        for opt in self._sound_fields.candidate:
-            sound_fields.append(opt.title)
-        return sound_fields
+        return self._sound_mode_list
 
     @property
     def sound_mode(self) -> str:
@@ -760,10 +784,10 @@ class SonyDevice:
         _LOG.debug("Sony AVR set input: %s", source)
         # switch to work.
         await self._receiver.set_power(True)
-        for out in self._sources.values():
-            if out.title == source:
-                await out.activate()
-                return ucapi.StatusCodes.OK
+        out = self._sources_by_title.get(source)
+        if out is not None:
+            await out.activate()
+            return ucapi.StatusCodes.OK
         _LOG.error("Sony AVR unable to find output: %s", source)
 
     @retry(bufferize=True)
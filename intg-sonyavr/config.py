@@ -5,38 +5,51 @@ Configuration handling of the integration driver.
 :license: Mozilla Public License Version 2.0, see LICENSE for more details.
 """
 
+import asyncio
 import dataclasses
-import json
 import logging
 import os
+import re
+import threading
 from dataclasses import dataclass
-from typing import Iterator
+from functools import lru_cache
 
+import orjson
 from ucapi import EntityTypes
 
 _LOG = logging.getLogger(__name__)
 
 _CFG_FILENAME = "config.json"
 
+DEFAULT_PORT = 10000
+DEFAULT_PATH = "/sony"
+# [scheme://]host[:port][/path], host may be a bracketed IPv6 address. Credentials, query and fragment are rejected.
+_URL_RE = re.compile(r"(?:(?P<scheme>https?)://)?(?P<host>\[[^\]\s]+\]|[^:/?#@\s]+)(?::(?P<port>\d+))?(?P<path>/.*)?")
+
 
 def create_entity_id(avr_id: str, entity_type: EntityTypes) -> str:
     """Create a unique entity identifier for the given receiver and entity type."""
     return f"{entity_type.value}.{avr_id}"
 
 
-def avr_from_entity_id(entity_id: str) -> str | None:
+@lru_cache(maxsize=64)
+def extract_url(host: str) -> str:
     """
-    Return the avr_id prefix of an entity_id.
+    Return the normalized endpoint URL of a Sony device.
 
-    The prefix is the part before the first dot in the name and refers to the AVR device identifier.
+    Missing scheme, port and path are completed with http, DEFAULT_PORT and DEFAULT_PATH.
 
-    :param entity_id: the entity identifier
-    :return: the device prefix, or None if entity_id doesn't contain a dot
+    :param host: IP address, hostname or (partial) endpoint URL
+    :return: the endpoint URL in the form http://<host>:<port><path>, the input if it cannot be parsed
     """
-    return entity_id.split(".", 1)[1]
+    match = _URL_RE.fullmatch(host.strip())
+    if match is None:
+        return host
+    scheme, port, path = match["scheme"] or "http", match["port"] or DEFAULT_PORT, match["path"] or DEFAULT_PATH
+    return f"{scheme}://{match['host'].lower()}:{port}{path}"
 
 
-@dataclass
+@dataclass(slots=True)
 class AvrDevice:
     """Sony device configuration."""
 
@@ -48,13 +61,12 @@ class AvrDevice:
     volume_step: float
 
 
-class _EnhancedJSONEncoder(json.JSONEncoder):
-    """Python dataclass json encoder."""
-
-    def default(self, o):
-        if dataclasses.is_dataclass(o):
-            return dataclasses.asdict(o)
-        return super().default(o)
+def _copy_device_settings(source: AvrDevice, target: AvrDevice) -> None:
+    """Copy the settings of a device configuration into an existing configuration instance."""
+    target.address = source.address
+    target.name = source.name
+    target.always_on = source.always_on
+    target.volume_step = source.volume_step
 
 
 class Devices:
@@ -69,8 +81,15 @@ class Devices:
         self._data_path: str = data_path
         self._cfg_file_path: str = os.path.join(data_path, _CFG_FILENAME)
         self._config: list[AvrDevice] = []
+        # index of the configured devices by identifier, kept in sync with _config
+        self._by_id: dict[str, AvrDevice] = {}
         self._add_handler = add_handler
         self._remove_handler = remove_handler
+        # the configuration file may be written from the event loop and from executor threads
+        self._write_lock = threading.Lock()
+        # sequence number of the last serialized and of the last written configuration
+        self._store_seq: int = 0
+        self._written_seq: int = 0
 
         self.load()
 
@@ -79,48 +98,48 @@ class Devices:
         """Return the configuration path."""
         return self._data_path
 
-    def all(self) -> Iterator[AvrDevice]:
-        """Get an iterator for all device configurations."""
-        return iter(self._config)
+    def all(self) -> list[AvrDevice]:
+        """Get all device configurations. The returned list must not be modified."""
+        return self._config
 
     def contains(self, avr_id: str) -> bool:
         """Check if there's a device with the given device identifier."""
-        for item in self._config:
-            if item.id == avr_id:
-                return True
-        return False
+        return avr_id in self._by_id
 
     def add(self, atv: AvrDevice) -> None:
-        """Add a new configured Sony device."""
-        # TODO duplicate check
-        self._config.append(atv)
+        """Add a new configured Sony device, an already configured device is updated instead."""
+        item = self._by_id.get(atv.id)
+        if item is None:
+            self._config.append(atv)
+            self._by_id[atv.id] = atv
+        else:
+            _copy_device_settings(atv, item)
         if self._add_handler is not None:
             self._add_handler(atv)
 
     def get(self, avr_id: str) -> AvrDevice | None:
         """Get device configuration for given identifier."""
-        for item in self._config:
-            if item.id == avr_id:
-                # return a copy
-                return dataclasses.replace(item)
-        return None
-
-    def update(self, atv: AvrDevice) -> bool:
-        """Update a configured Sony device and persist configuration."""
-        for item in self._config:
-            if item.id == atv.id:
-                item.address = atv.address
-                item.name = atv.name
-                item.always_on = atv.always_on
-                item.volume_step = atv.volume_step
-                return self.store()
-        return False
+        item = self._by_id.get(avr_id)
+        if item is None:
+            return None
+        # return a copy
+        return dataclasses.replace(item)
+
+    async def update(self, atv: AvrDevice) -> bool:
+        """Update a configured Sony device and persist configuration without blocking the event loop."""
+        item = self._by_id.get(atv.id)
+        if item is None:
+            return False
+        _copy_device_settings(atv, item)
+        return await self.astore()
 
     def remove(self, avr_id: str) -> bool:
         """Remove the given device configuration."""
-        atv = self.get(avr_id)
+        atv = self._by_id.pop(avr_id, None)
         if atv is None:
             return False
+        with self._write_lock:
+            self._discard_pending_writes()
         try:
             self._config.remove(atv)
             if self._remove_handler is not None:
@@ -133,25 +152,78 @@ class Devices:
     def clear(self) -> None:
         """Remove the configuration file."""
         self._config = []
+        self._by_id = {}
 
-        if os.path.exists(self._cfg_file_path):
-            os.remove(self._cfg_file_path)
+        with self._write_lock:
+            self._discard_pending_writes()
+            if os.path.exists(self._cfg_file_path):
+                os.remove(self._cfg_file_path)
 
         if self._remove_handler is not None:
             self._remove_handler(None)
 
+    def _discard_pending_writes(self) -> None:
+        """
+        Skip the writes of already serialized configurations, which may still be waiting in the executor.
+
+        Must be called with the write lock held.
+        """
+        self._store_seq += 1
+        self._written_seq = self._store_seq
+
     def store(self) -> bool:
         """
         Store the configuration file.
 
         :return: True if the configuration could be saved.
         """
-        try:
-            with open(self._cfg_file_path, "w+", encoding="utf-8") as f:
-                json.dump(self._config, f, ensure_ascii=False, cls=_EnhancedJSONEncoder)
-            return True
-        except OSError:
-            _LOG.error("Cannot write the config file")
+        return self._write(*self._serialize())
+
+    async def astore(self) -> bool:
+        """
+        Store the configuration file without blocking the event loop.
+
+        The configuration is serialized on the calling thread, the file is written in the default executor.
+
+        :return: True if the configuration could be saved.
+        """
+        seq, data = self._serialize()
+        return await asyncio.get_running_loop().run_in_executor(None, self._write, seq, data)
+
+    def _serialize(self) -> tuple[int, bytes]:
+        """
+        Serialize the device configurations to UTF-8 encoded JSON.
+
+        :return: sequence number and serialized configuration
+        """
+        self._store_seq += 1
+        # orjson serializes dataclasses natively and emits UTF-8 bytes
+        return self._store_seq, orjson.dumps(self._config)
+
+    def _write(self, seq: int, data: bytes) -> bool:
+        """
+        Write the serialized configuration to the configuration file.
+
+        :param seq: sequence number of the serialized configuration
+        :param data: serialized configuration
+        :return: True if the configuration could be saved.
+        """
+        # write to a temporary file first: an interrupted write must not leave a truncated configuration
+        tmp_file_path = self._cfg_file_path + ".tmp"
+        with self._write_lock:
+            # executor writes may complete out of order: never replace a newer configuration
+            if seq < self._written_seq:
+                return True
+            try:
+                with open(tmp_file_path, "wb") as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_file_path, self._cfg_file_path)
+                self._written_seq = seq
+                return True
+            except OSError:
+                _LOG.error("Cannot write the config file")
 
         return False
 
@@ -162,18 +234,28 @@ class Devices:
         :return: True if the configuration could be loaded.
         """
         try:
-            with open(self._cfg_file_path, "r", encoding="utf-8") as f:
-                data = json.load(f)
+            with open(self._cfg_file_path, "rb") as f:
+                data = orjson.loads(f.read())
+            # parse into a new list first: the current configuration is only replaced if the whole file is valid
+            config: list[AvrDevice] = []
             for item in data:
                 # not using AtvDevice(**item) to be able to migrate old configuration files with missing attributes
+                always_on = item.get("always_on")
+                if always_on is None:
+                    always_on = False
+                volume_step = item.get("volume_step")
+                if volume_step is None:
+                    volume_step = 2.0
                 device_instance = AvrDevice(
                     item.get("id"),
                     item.get("name"),
                     item.get("address"),
-                    item.get("always_on", False),
-                    item.get("volume_step", 2.0)
+                    always_on,
+                    volume_step,
                 )
-                self._config.append(device_instance)
+                config.append(device_instance)
+            self._config = config
+            self._by_id = {item.id: item for item in config}
             return True
         except OSError:
             _LOG.error("Cannot open the config file")
@@ -1,7 +1,9 @@
+# Map of simple command -> (sound setting, value)
+SIMPLE_COMMAND_SETTINGS = {
+    "ZONE_HDMI_OUTPUT_AB": ("hdmiOutput", "hdmi_AB"),
+    "ZONE_HDMI_OUTPUT_A": ("hdmiOutput", "hdmi_A"),
+    "ZONE_HDMI_OUTPUT_B": ("hdmiOutput", "hdmi_B"),
+    "ZONE_HDMI_OUTPUT_OFF": ("hdmiOutput", "off"),
+}
 
-SIMPLE_COMMANDS = [
-    "ZONE_HDMI_OUTPUT_AB",
-    "ZONE_HDMI_OUTPUT_A",
-    "ZONE_HDMI_OUTPUT_B",
-    "ZONE_HDMI_OUTPUT_OFF"
-]
\ No newline at end of file
+SIMPLE_COMMANDS = list(SIMPLE_COMMAND_SETTINGS)
@@ -11,30 +11,46 @@ from songpal.discovery import Discover, DiscoveredDevice
 
 _LOG = logging.getLogger(__name__)
 
-TIMEOUT = 5
-_found_devices: list[DiscoveredDevice] = []
+# most receivers answer within the first second: start with a short scan
+TIMEOUT = 2
+# second scan for slow devices, only used if the short scan didn't find anything: both scans together take at most
+# as long as the previous single 5 seconds scan
+RETRY_TIMEOUT = 3
 
 
-async def sony_avrs() -> list[DiscoveredDevice]:
+async def _discover(timeout: int) -> list[DiscoveredDevice]:
     """
-    Discover Sony AVRs on the network with SSDP.
-
-    Returns a list of dictionaries which includes all discovered Sony AVR
-    devices with keys "host", "modelName", "friendlyName", "presentationURL".
-    By default, SSDP broadcasts are sent once with a 2 seconds timeout.
+    Run a single SSDP discovery.
 
+    :param timeout: discovery timeout in seconds
     :return: array of device information objects.
     """
-    global _found_devices
+    found_devices: list[DiscoveredDevice] = []
 
     async def discovered_devices(discovered_device: DiscoveredDevice):
-        _found_devices.append(discovered_device)
+        found_devices.append(discovered_device)
 
     try:
-        _LOG.debug("Starting discovery")
-        _found_devices = []
-        await Discover.discover(TIMEOUT, _LOG.level, callback=discovered_devices)
-        return _found_devices
+        _LOG.debug("Starting discovery with a %ss timeout", timeout)
+        await Discover.discover(timeout, _LOG.level, callback=discovered_devices)
+        return found_devices
     except Exception as ex:  # pylint: disable=broad-exception-caught
         _LOG.error("Failed to start discovery: %s", ex)
         return []
+
+
+async def sony_avrs() -> list[DiscoveredDevice]:
+    """
+    Discover Sony AVRs on the network with SSDP.
+
+    Returns a list of dictionaries which includes all discovered Sony AVR
+    devices with keys "host", "modelName", "friendlyName", "presentationURL".
+    SSDP broadcasts are sent with a TIMEOUT seconds timeout, and once more with
+    RETRY_TIMEOUT seconds if no device answered.
+
+    :return: array of device information objects.
+    """
+    found_devices = await _discover(TIMEOUT)
+    if not found_devices:
+        found_devices = await _discover(RETRY_TIMEOUT)
+    return found_devices
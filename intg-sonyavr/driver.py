@@ -9,24 +9,62 @@ This module implements a Remote Two integration driver for Sony AVR receivers.
 import asyncio
 import logging
 import os
-from typing import Any
+from typing import Any, Coroutine
 
 import avr
 import config
 import media_player
 import setup_flow
 import ucapi
-from config import avr_from_entity_id
 from ucapi.media_player import Attributes as MediaAttr
+from ucapi.media_player import States
+
+try:
+    import uvloop
+except ImportError:  # pragma: no cover - uvloop is POSIX only
+    uvloop = None
 
 _LOG = logging.getLogger("driver")  # avoid having __main__ in log messages
-_LOOP = asyncio.get_event_loop()
+_INFO = logging.INFO
+# libuv based event loop if available, the default asyncio loop otherwise
+_LOOP = uvloop.new_event_loop() if uvloop is not None else asyncio.new_event_loop()
+asyncio.set_event_loop(_LOOP)
 
 # Global variables
 api = ucapi.IntegrationAPI(_LOOP)
 # Map of avr_id -> SonyAVR instance
 _configured_avrs: dict[str, avr.SonyDevice] = {}
+# Map of avr_id -> entity identifiers, maintained when registering / removing entities
+_avr_to_entities: dict[str, tuple[str, ...]] = {}
 _R2_IN_STANDBY = False
+_MEDIA_PLAYER_PREFIX = f"{ucapi.EntityTypes.MEDIA_PLAYER.value}."
+
+
+def _avr_id_from_media_entity(entity_id: str) -> str | None:
+    """
+    Return the AVR identifier of a media-player entity identifier.
+
+    :param entity_id: the entity identifier
+    :return: the AVR identifier, or None if entity_id isn't a media-player entity
+    """
+    if entity_id.startswith(_MEDIA_PLAYER_PREFIX):
+        return entity_id.removeprefix(_MEDIA_PLAYER_PREFIX)
+    return None
+
+
+async def _gather_receivers(action: str, coroutines: list[Coroutine[Any, Any, Any]]) -> None:
+    """
+    Run the given receiver commands concurrently.
+
+    A failing receiver is logged and doesn't abort the commands of the other receivers.
+
+    :param action: description of the commands for logging
+    :param coroutines: receiver commands to run
+    """
+    results = await asyncio.gather(*coroutines, return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            _LOG.error("%s failed: %s", action, result)
 
 
 @api.listens_to(ucapi.Events.CONNECT)
@@ -34,14 +72,15 @@ async def on_r2_connect_cmd() -> None:
     """Connect all configured receivers when the Remote Two sends the connect command."""
     # TODO check if we were in standby and ignore the call? We'll also get an EXIT_STANDBY
     _LOG.debug("R2 connect command: connecting device(s)")
+    tasks = []
     for receiver in _configured_avrs.values():
-        # start background task
         if receiver.available:
             _LOG.debug("R2 connect : device %s already active", receiver.receiver.endpoint)
-            await receiver.connect_event()
-            continue
-        await receiver.connect()
-    if len(_configured_avrs.values()) == 0:
+            tasks.append(receiver.connect_event())
+        else:
+            tasks.append(receiver.connect())
+    await _gather_receivers("R2 connect", tasks)
+    if not _configured_avrs:
         await api.set_device_state(ucapi.DeviceStates.CONNECTED)
         # _LOOP.create_task(receiver.connect())
 
@@ -51,11 +90,8 @@ async def on_r2_disconnect_cmd():
     """Disconnect all configured receivers when the Remote Two sends the disconnect command."""
     # pylint: disable = W0212
     _LOG.debug("Remote requests disconnection")
-    if len(api._clients) == 0:
-        for receiver in _configured_avrs.values():
-            # start background task
-            await receiver.disconnect()
-            # _LOOP.create_task(receiver.disconnect())
+    if not api._clients:
+        await _gather_receivers("R2 disconnect", [receiver.disconnect() for receiver in _configured_avrs.values()])
 
 
 @api.listens_to(ucapi.Events.ENTER_STANDBY)
@@ -69,8 +105,7 @@ async def on_r2_enter_standby() -> None:
 
     _R2_IN_STANDBY = True
     _LOG.debug("Enter standby event: disconnecting device(s)")
-    for configured in _configured_avrs.values():
-        await configured.disconnect()
+    await _gather_receivers("Enter standby", [configured.disconnect() for configured in _configured_avrs.values()])
 
 
 @api.listens_to(ucapi.Events.EXIT_STANDBY)
@@ -85,17 +120,13 @@ async def on_r2_exit_standby() -> None:
     _R2_IN_STANDBY = False
     _LOG.debug("Exit standby event: connecting device(s)")
 
+    tasks = []
     for configured in _configured_avrs.values():
-        # start background task
-        # pylint: disable = W0212
         if configured.available:
-            _LOG.debug(
-                "Exit standby event : device %s already active",
-                configured._receiver.endpoint,
-            )
+            _LOG.debug("Exit standby event : device %s already active", configured.receiver.endpoint)
             continue
-        await configured.connect()
-        # _LOOP.create_task(configured.connect())
+        tasks.append(configured.connect())
+    await _gather_receivers("Exit standby", tasks)
 
 
 @api.listens_to(ucapi.Events.SUBSCRIBE_ENTITIES)
@@ -109,12 +140,21 @@ async def on_subscribe_entities(entity_ids: list[str]) -> None:
 
     _R2_IN_STANDBY = False
     _LOG.debug("Subscribe entities event: %s", entity_ids)
+    # receiver attributes are computed once per AVR, not once per subscribed entity
+    by_avr: dict[str, dict[str, Any]] = {}
     for entity_id in entity_ids:
-        avr_id = avr_from_entity_id(entity_id)
-        if avr_id in _configured_avrs:
-            receiver = _configured_avrs[avr_id]
-            attributes = receiver.attributes
-            api.configured_entities.update_attributes(entity_id, attributes)
+        avr_id = _avr_id_from_media_entity(entity_id)
+        receiver = _configured_avrs.get(avr_id)
+        if receiver is not None:
+            attributes = by_avr.get(avr_id)
+            if attributes is None:
+                attributes = by_avr[avr_id] = receiver.attributes
+            configured_entity = api.configured_entities.get(entity_id)
+            if configured_entity is not None:
+                current = configured_entity.attributes
+                attributes = {key: value for key, value in attributes.items() if current.get(key) != value}
+            if attributes:
+                api.configured_entities.update_attributes(entity_id, attributes)
             continue
 
         device = config.devices.get(avr_id)
@@ -129,18 +169,39 @@ async def on_unsubscribe_entities(entity_ids: list[str]) -> None:
     """On unsubscribe, we disconnect the objects and remove listeners for events."""
     _LOG.debug("Unsubscribe entities event: %s", entity_ids)
     for entity_id in entity_ids:
-        avr_id = avr_from_entity_id(entity_id)
+        avr_id = _avr_id_from_media_entity(entity_id)
         if avr_id is None:
             continue
-        if avr_id in _configured_avrs:
+        receiver = _configured_avrs.get(avr_id)
+        if receiver is not None:
             # TODO #21 this doesn't work once we have more than one entity per device!
             # --- START HACK ---
             # Since an AVR instance only provides exactly one media-player, it's save to disconnect if the entity is
             # unsubscribed. This should be changed to a more generic logic, also as template for other integrations!
             # Otherwise this sets a bad copy-paste example and leads to more issues in the future.
             # --> correct logic: check configured_entities, if empty: disconnect
-            await _configured_avrs[entity_id].disconnect()
-            _configured_avrs[entity_id].events.remove_all_listeners()
+            # Listeners are kept: the receiver stays configured and is reused on the next subscription.
+            # They are only dropped in _async_remove when the device is removed from the configuration.
+            await receiver.disconnect()
+
+
+def _set_media_player_state(avr_id: str, state: States, current_state: States | None = None) -> None:
+    """
+    Set the state of the configured media-player entities of the given AVR.
+
+    :param avr_id: AVR identifier
+    :param state: new entity state
+    :param current_state: only update entities currently in this state, None to update all entities
+    """
+    get_entity = api.configured_entities.get
+    update_attributes = api.configured_entities.update_attributes
+    attributes = {MediaAttr.STATE: state}
+    for entity_id in _entities_from_avr(avr_id):
+        configured_entity = get_entity(entity_id)
+        if configured_entity is None or configured_entity.entity_type is not ucapi.EntityTypes.MEDIA_PLAYER:
+            continue
+        if current_state is None or configured_entity.attributes[MediaAttr.STATE] == current_state:
+            update_attributes(entity_id, attributes)
 
 
 async def on_avr_connected(avr_id: str):
@@ -154,37 +215,15 @@ async def on_avr_connected(avr_id: str):
     # TODO #20 when multiple devices are supported, the device state logic isn't that simple anymore!
     await api.set_device_state(ucapi.DeviceStates.CONNECTED)
 
-    for entity_id in _entities_from_avr(avr_id):
-        configured_entity = api.configured_entities.get(entity_id)
-        if configured_entity is None:
-            continue
-
-        if configured_entity.entity_type == ucapi.EntityTypes.MEDIA_PLAYER:
-            if (
-                configured_entity.attributes[ucapi.media_player.Attributes.STATE]
-                == ucapi.media_player.States.UNAVAILABLE
-            ):
-                # TODO why STANDBY?
-                api.configured_entities.update_attributes(
-                    entity_id,
-                    {ucapi.media_player.Attributes.STATE: ucapi.media_player.States.STANDBY},
-                )
+    # TODO why STANDBY?
+    _set_media_player_state(avr_id, States.STANDBY, current_state=States.UNAVAILABLE)
 
 
 async def on_avr_disconnected(avr_id: str):
     """Handle AVR disconnection."""
     _LOG.debug("AVR disconnected: %s", avr_id)
 
-    for entity_id in _entities_from_avr(avr_id):
-        configured_entity = api.configured_entities.get(entity_id)
-        if configured_entity is None:
-            continue
-
-        if configured_entity.entity_type == ucapi.EntityTypes.MEDIA_PLAYER:
-            api.configured_entities.update_attributes(
-                entity_id,
-                {ucapi.media_player.Attributes.STATE: ucapi.media_player.States.UNAVAILABLE},
-            )
+    _set_media_player_state(avr_id, States.UNAVAILABLE)
 
     # TODO #20 when multiple devices are supported, the device state logic isn't that simple anymore!
     await api.set_device_state(ucapi.DeviceStates.DISCONNECTED)
@@ -194,16 +233,7 @@ async def on_avr_connection_error(avr_id: str, message):
     """Set entities of AVR to state UNAVAILABLE if AVR connection error occurred."""
     _LOG.error(message)
 
-    for entity_id in _entities_from_avr(avr_id):
-        configured_entity = api.configured_entities.get(entity_id)
-        if configured_entity is None:
-            continue
-
-        if configured_entity.entity_type == ucapi.EntityTypes.MEDIA_PLAYER:
-            api.configured_entities.update_attributes(
-                entity_id,
-                {ucapi.media_player.Attributes.STATE: ucapi.media_player.States.UNAVAILABLE},
-            )
+    _set_media_player_state(avr_id, States.UNAVAILABLE)
 
     # TODO #20 when multiple devices are supported, the device state logic isn't that simple anymore!
     await api.set_device_state(ucapi.DeviceStates.ERROR)
@@ -211,6 +241,8 @@ async def on_avr_connection_error(avr_id: str, message):
 
 async def handle_avr_address_change(avr_id: str, address: str) -> None:
     """Update device configuration with changed IP address."""
+    # configured addresses are normalized endpoints, the reported one may be a bare IP address
+    address = config.extract_url(address)
     device = config.devices.get(avr_id)
     if device and device.address != address:
         _LOG.info(
@@ -220,62 +252,82 @@ async def handle_avr_address_change(avr_id: str, address: str) -> None:
             address,
         )
         device.address = address
-        config.devices.update(device)
+        await config.devices.update(device)
 
 
-async def on_avr_update(avr_id: str, update: dict[str, Any] | None) -> None:
+def _configured_entities_from_avr(avr_id: str) -> list[ucapi.Entity]:
     """
-    Update attributes of configured media-player entity if AVR properties changed.
+    Return the configured entities of the given AVR.
 
     :param avr_id: AVR identifier
-    :param update: dictionary containing the updated properties or None if
+    :return: list of configured entities, empty if no entity of the AVR is configured
     """
-    if update is None:
-        if avr_id not in _configured_avrs:
-            return
-        receiver = _configured_avrs[avr_id]
-        update = {
-            MediaAttr.STATE: receiver.state,
-            MediaAttr.MEDIA_ARTIST: receiver.media_artist,
-            MediaAttr.MEDIA_ALBUM: receiver.media_album_name,
-            MediaAttr.MEDIA_IMAGE_URL: receiver.media_image_url,
-            MediaAttr.MEDIA_TITLE: receiver.media_title,
-            MediaAttr.MUTED: receiver.is_volume_muted,
-            MediaAttr.SOURCE: receiver.source,
-            MediaAttr.SOURCE_LIST: receiver.source_list,
-            MediaAttr.SOUND_MODE: receiver.sound_mode,
-            MediaAttr.SOUND_MODE_LIST: receiver.sound_mode_list,
-            MediaAttr.VOLUME: receiver.volume_level,
-        }
-    else:
-        _LOG.info("[%s] AVR update: %s", avr_id, update)
-
-    attributes = None
-
-    # TODO awkward logic: this needs better support from the integration library
+    configured_entities = []
     for entity_id in _entities_from_avr(avr_id):
         configured_entity = api.configured_entities.get(entity_id)
-        if configured_entity is None:
-            return
+        if configured_entity is not None:
+            configured_entities.append(configured_entity)
+    return configured_entities
 
+
+def _update_configured_entities(configured_entities: list[ucapi.Entity], update: dict[str, Any]) -> None:
+    """Send the changed attributes of the given update to the configured entities."""
+    # TODO awkward logic: this needs better support from the integration library
+    for configured_entity in configured_entities:
+        attributes = None
         if isinstance(configured_entity, media_player.SonyMediaPlayer):
             attributes = configured_entity.filter_changed_attributes(update)
 
         if attributes:
             # _LOG.debug("Sony AVR send updated attributes %s %s", entity_id, attributes)
-            api.configured_entities.update_attributes(entity_id, attributes)
+            api.configured_entities.update_attributes(configured_entity.id, attributes)
+
+
+async def on_avr_full_refresh(avr_id: str) -> None:
+    """
+    Update attributes of configured media-player entity from the current AVR properties.
+
+    :param avr_id: AVR identifier
+    """
+    # resolve the consumers first: no need to read the AVR properties if no entity is configured yet
+    configured_entities = _configured_entities_from_avr(avr_id)
+    if not configured_entities:
+        return
+    receiver = _configured_avrs.get(avr_id)
+    if receiver is None:
+        return
+
+    # the receiver builds the complete attribute snapshot in one call
+    update = receiver.attributes
+    _update_configured_entities(configured_entities, update)
+
+
+async def on_avr_update(avr_id: str, update: dict[str, Any]) -> None:
+    """
+    Update attributes of configured media-player entity if AVR properties changed.
+
+    :param avr_id: AVR identifier
+    :param update: dictionary containing the updated properties
+    """
+    configured_entities = _configured_entities_from_avr(avr_id)
+    if not configured_entities:
+        return
+
+    if _LOG.isEnabledFor(_INFO):
+        _LOG.info("[%s] AVR update: %s", avr_id, update)
+    _update_configured_entities(configured_entities, update)
 
 
-def _entities_from_avr(avr_id: str) -> list[str]:
+def _entities_from_avr(avr_id: str) -> tuple[str, ...]:
     """
     Return all associated entity identifiers of the given AVR.
 
     :param avr_id: the AVR identifier
-    :return: list of entity identifiers
+    :return: tuple of entity identifiers
     """
     # dead simple for now: one media_player entity per device!
     # TODO #21 support multiple zones: one media-player per zone
-    return [f"media_player.{avr_id}"]
+    return _avr_to_entities.get(avr_id, ())
 
 
 def _configure_new_avr(device: config.AvrDevice, connect: bool = True) -> None:
@@ -289,18 +341,19 @@ def _configure_new_avr(device: config.AvrDevice, connect: bool = True) -> None:
     """
     # the device should not yet be configured, but better be safe
     if device.id in _configured_avrs:
-        receiver = _configured_avrs[device.id]
-        _LOOP.create_task(receiver.disconnect())
-    else:
-        receiver = avr.SonyDevice(device, loop=_LOOP)
+        _LOOP.create_task(_reconfigure_avr(device, _configured_avrs[device.id], connect))
+        return
+
+    receiver = avr.SonyDevice(device, loop=_LOOP)
 
-        receiver.events.on(avr.Events.CONNECTED, on_avr_connected)
-        receiver.events.on(avr.Events.DISCONNECTED, on_avr_disconnected)
-        receiver.events.on(avr.Events.ERROR, on_avr_connection_error)
-        receiver.events.on(avr.Events.UPDATE, on_avr_update)
-        # receiver.events.on(avr.Events.IP_ADDRESS_CHANGED, handle_avr_address_change)
-        # receiver.connect()
-        _configured_avrs[device.id] = receiver
+    receiver.events.on(avr.Events.CONNECTED, on_avr_connected)
+    receiver.events.on(avr.Events.DISCONNECTED, on_avr_disconnected)
+    receiver.events.on(avr.Events.ERROR, on_avr_connection_error)
+    receiver.events.on(avr.Events.UPDATE, on_avr_update)
+    receiver.events.on(avr.Events.FULL_REFRESH, on_avr_full_refresh)
+    # receiver.events.on(avr.Events.IP_ADDRESS_CHANGED, handle_avr_address_change)
+    # receiver.connect()
+    _configured_avrs[device.id] = receiver
 
     if connect:
         # start background connection task
@@ -309,6 +362,26 @@ def _configure_new_avr(device: config.AvrDevice, connect: bool = True) -> None:
     _register_available_entities(device, receiver)
 
 
+async def _reconfigure_avr(device: config.AvrDevice, receiver: avr.SonyDevice, connect: bool) -> None:
+    """
+    Reconfigure an already configured AVR device.
+
+    The entities are registered again once the existing connection is closed, even if reconnecting fails.
+
+    :param device: the receiver configuration.
+    :param receiver: the existing receiver instance.
+    :param connect: True: reconnect to receiver.
+    """
+    try:
+        await receiver.disconnect()
+        if connect:
+            await receiver.connect()
+    except Exception as ex:  # pylint: disable=broad-exception-caught
+        _LOG.error("Failed to reconnect AVR %s: %s", device.id, ex)
+    finally:
+        _register_available_entities(device, receiver)
+
+
 def _register_available_entities(device: config.AvrDevice, receiver: avr.SonyDevice) -> None:
     """
     Create entities for given receiver device and register them as available entities.
@@ -322,6 +395,7 @@ def _register_available_entities(device: config.AvrDevice, receiver: avr.SonyDev
     if api.available_entities.contains(entity.id):
         api.available_entities.remove(entity.id)
     api.available_entities.add(entity)
+    _avr_to_entities[device.id] = (entity.id,)
 
 
 def on_device_added(device: config.AvrDevice) -> None:
@@ -337,6 +411,7 @@ def on_device_removed(device: config.AvrDevice | None) -> None:
         for configured in _configured_avrs.values():
             _LOOP.create_task(_async_remove(configured))
         _configured_avrs.clear()
+        _avr_to_entities.clear()
         api.configured_entities.clear()
         api.available_entities.clear()
     else:
@@ -344,7 +419,7 @@ def on_device_removed(device: config.AvrDevice | None) -> None:
             _LOG.debug("Disconnecting from removed AVR %s", device.id)
             configured = _configured_avrs.pop(device.id)
             _LOOP.create_task(_async_remove(configured))
-            for entity_id in _entities_from_avr(configured.id):
+            for entity_id in _avr_to_entities.pop(configured.id, ()):
                 api.configured_entities.remove(entity_id)
                 api.available_entities.remove(entity_id)
 
@@ -371,14 +446,30 @@ async def main():
         _configure_new_avr(device, connect=False)
 
     # _LOOP.create_task(receiver_status_poller())
+    tasks = []
     for receiver in _configured_avrs.values():
         if receiver.available:
             _LOG.debug("Main driver : device %s already active", receiver.receiver.endpoint)
             continue
-        await receiver.connect()
+        tasks.append(receiver.connect())
+    await _gather_receivers("Driver startup connection", tasks)
     await api.init("driver.json", setup_flow.driver_setup_handler)
 
 
+def _stop_on_error(task: asyncio.Task) -> None:
+    """Stop the event loop if the driver initialization failed."""
+    if not task.cancelled() and task.exception() is not None:
+        _LOOP.stop()
+
+
 if __name__ == "__main__":
-    _LOOP.run_until_complete(main())
-    _LOOP.run_forever()
+    # start the loop only once: main() runs as the first task and the driver keeps serving events afterwards
+    main_task = _LOOP.create_task(main())
+    main_task.add_done_callback(_stop_on_error)
+    try:
+        _LOOP.run_forever()
+        if main_task.done():
+            # raise the initialization error, if any
+            main_task.result()
+    finally:
+        _LOOP.close()
@@ -6,42 +6,111 @@ Media-player entity functions.
 """
 
 import logging
-from typing import Any
+from typing import Any, Awaitable, Callable
 
 import avr
 from config import AvrDevice, create_entity_id
 from ucapi import EntityTypes, MediaPlayer, StatusCodes
 from ucapi.media_player import Attributes, Commands, DeviceClasses, Features, States, Options
 
-from const import SIMPLE_COMMANDS
+from const import SIMPLE_COMMAND_SETTINGS, SIMPLE_COMMANDS
 
 _LOG = logging.getLogger(__name__)
+_INFO = logging.INFO
+
+# Attribute keys bound once at import time: filter_changed_attributes is called for every AVR update
+_A_STATE = Attributes.STATE
+_A_MUTED = Attributes.MUTED
+_A_VOLUME = Attributes.VOLUME
+_A_SOURCE = Attributes.SOURCE
+_A_SOURCE_LIST = Attributes.SOURCE_LIST
+_A_SOUND_MODE = Attributes.SOUND_MODE
+_A_SOUND_MODE_LIST = Attributes.SOUND_MODE_LIST
+_A_MEDIA_ARTIST = Attributes.MEDIA_ARTIST
+_A_MEDIA_ALBUM = Attributes.MEDIA_ALBUM
+_A_MEDIA_IMAGE_URL = Attributes.MEDIA_IMAGE_URL
+_A_MEDIA_TITLE = Attributes.MEDIA_TITLE
+_A_MEDIA_TYPE = Attributes.MEDIA_TYPE
+_F_SELECT_SOUND_MODE = Features.SELECT_SOUND_MODE
+_S_OFF = States.OFF
+# media attributes cleared when the receiver is turned off
+_OFF_CLEAR = {
+    _A_MEDIA_IMAGE_URL: "",
+    _A_MEDIA_ALBUM: "",
+    _A_MEDIA_ARTIST: "",
+    _A_MEDIA_TITLE: "",
+    _A_MEDIA_TYPE: "",
+    _A_SOURCE: "",
+}
+# scalar attributes compared as a whole to detect repeated identical updates
+_SNAPSHOT_KEYS = (
+    _A_STATE,
+    _A_MUTED,
+    _A_SOURCE,
+    _A_VOLUME,
+    _A_SOUND_MODE,
+    _A_MEDIA_TITLE,
+    _A_MEDIA_ARTIST,
+    _A_MEDIA_ALBUM,
+    _A_MEDIA_IMAGE_URL,
+)
+_LIST_KEYS = frozenset((_A_SOURCE_LIST, _A_SOUND_MODE_LIST))
+# Map of command -> (SonyDevice method, command parameter passed to it), keyed by the plain command string as sent by
+# the integration API. MUTE_TOGGLE depends on the entity state and is handled in the command method.
+_COMMAND_METHODS: dict[str, tuple[str, str | None]] = {
+    Commands.VOLUME.value: ("set_volume_level", "volume"),
+    Commands.VOLUME_UP.value: ("volume_up", None),
+    Commands.VOLUME_DOWN.value: ("volume_down", None),
+    Commands.ON.value: ("power_on", None),
+    Commands.OFF.value: ("power_off", None),
+    Commands.SELECT_SOURCE.value: ("select_source", "source"),
+    Commands.SELECT_SOUND_MODE.value: ("select_sound_mode", "mode"),
+    Commands.NEXT.value: ("next", None),
+    Commands.PREVIOUS.value: ("previous", None),
+    Commands.PLAY_PAUSE.value: ("play_pause", None),
+}
 
 
 class SonyMediaPlayer(MediaPlayer):
     """Representation of a Sony Media Player entity."""
 
+    _DEFAULT_FEATURES: tuple[Features, ...] = (
+        Features.ON_OFF,
+        Features.VOLUME,
+        Features.VOLUME_UP_DOWN,
+        Features.MUTE_TOGGLE,
+        Features.SELECT_SOURCE,
+        Features.SELECT_SOUND_MODE,
+        Features.MEDIA_ALBUM,
+        Features.MEDIA_TITLE,
+        Features.MEDIA_ARTIST,
+        Features.MEDIA_IMAGE_URL,
+        Features.MEDIA_TYPE,
+        Features.NEXT,
+        Features.PREVIOUS,
+        Features.PLAY_PAUSE,
+    )
+    _SCALAR_ATTRS: tuple[Attributes, ...] = (
+        _A_STATE,
+        _A_MEDIA_ARTIST,
+        _A_MEDIA_ALBUM,
+        _A_MEDIA_IMAGE_URL,
+        _A_MEDIA_TITLE,
+        _A_MUTED,
+        _A_SOURCE,
+        _A_VOLUME,
+    )
+
     def __init__(self, device: AvrDevice, receiver: avr.SonyDevice):
         """Initialize the class."""
         self._receiver: avr.SonyDevice = receiver
+        self._command_handlers: dict[str, tuple[Callable[..., Awaitable[StatusCodes]], str | None]] = {
+            cmd_id: (getattr(receiver, method), param) for cmd_id, (method, param) in _COMMAND_METHODS.items()
+        }
+        # scalar values of the last filtered update and the entity state expected after it
+        self._last_update: tuple[tuple, Any] | None = None
 
         entity_id = create_entity_id(device.id, EntityTypes.MEDIA_PLAYER)
-        features = [
-            Features.ON_OFF,
-            Features.VOLUME,
-            Features.VOLUME_UP_DOWN,
-            Features.MUTE_TOGGLE,
-            Features.SELECT_SOURCE,
-            Features.SELECT_SOUND_MODE,
-            Features.MEDIA_ALBUM,
-            Features.MEDIA_TITLE,
-            Features.MEDIA_ARTIST,
-            Features.MEDIA_IMAGE_URL,
-            Features.MEDIA_TYPE,
-            Features.NEXT,
-            Features.PREVIOUS,
-            Features.PLAY_PAUSE,
-        ]
         attributes = {
             Attributes.STATE: receiver.state,
             Attributes.VOLUME: receiver.volume_level,
@@ -64,7 +133,8 @@ class SonyMediaPlayer(MediaPlayer):
         super().__init__(
             entity_id,
             device.name,
-            features,
+            # the entity keeps the features as instance state: don't share the class tuple
+            list(self._DEFAULT_FEATURES),
             attributes,
             device_class=DeviceClasses.RECEIVER,
             options={Options.SIMPLE_COMMANDS: SIMPLE_COMMANDS}
@@ -80,47 +150,28 @@ class SonyMediaPlayer(MediaPlayer):
         :param params: optional command parameters
         :return: status code of the command request
         """
-        _LOG.info("Got %s command request: %s %s", self.id, cmd_id, params)
+        if _LOG.isEnabledFor(_INFO):
+            _LOG.info("Got %s command request: %s %s", self.id, cmd_id, params)
 
         if self._receiver is None:
             _LOG.warning("No AVR instance for entity: %s", self.id)
             return StatusCodes.SERVICE_UNAVAILABLE
 
-        if cmd_id == Commands.VOLUME:
-            res = await self._receiver.set_volume_level(params.get("volume"))
-        elif cmd_id == Commands.VOLUME_UP:
-            res = await self._receiver.volume_up()
-        elif cmd_id == Commands.VOLUME_DOWN:
-            res = await self._receiver.volume_down()
-        elif cmd_id == Commands.MUTE_TOGGLE:
-            res = await self._receiver.mute(not self.attributes[Attributes.MUTED])
-        elif cmd_id == Commands.ON:
-            res = await self._receiver.power_on()
-        elif cmd_id == Commands.OFF:
-            res = await self._receiver.power_off()
-        elif cmd_id == Commands.SELECT_SOURCE:
-            res = await self._receiver.select_source(params.get("source"))
-        elif cmd_id == Commands.SELECT_SOUND_MODE:
-            res = await self._receiver.select_sound_mode(params.get("mode"))
-        elif cmd_id == Commands.NEXT:
-            res = await self._receiver.next()
-        elif cmd_id == Commands.PREVIOUS:
-            res = await self._receiver.previous()
-        elif cmd_id == Commands.PLAY_PAUSE:
-            res = await self._receiver.play_pause()
-        elif cmd_id in self.options[Options.SIMPLE_COMMANDS]:
-            if cmd_id == "ZONE_HDMI_OUTPUT_AB":
-                res = await self._receiver.set_sound_settings('hdmiOutput', 'hdmi_AB')
-            elif cmd_id == "ZONE_HDMI_OUTPUT_A":
-                res = await self._receiver.set_sound_settings('hdmiOutput', 'hdmi_A')
-            elif cmd_id == "ZONE_HDMI_OUTPUT_B":
-                res = await self._receiver.set_sound_settings('hdmiOutput', 'hdim_B')
-            elif cmd_id == "ZONE_HDMI_OUTPUT_OFF":
-                res = await self._receiver.set_sound_settings('hdmiOutput', 'off')
-        else:
-            return StatusCodes.NOT_IMPLEMENTED
-
-        return res
+        if cmd_id == Commands.MUTE_TOGGLE.value:
+            return await self._receiver.mute(not self.attributes[_A_MUTED])
+
+        handler = self._command_handlers.get(cmd_id)
+        if handler is not None:
+            method, param = handler
+            if param is None:
+                return await method()
+            return await method(params.get(param))
+
+        setting = SIMPLE_COMMAND_SETTINGS.get(cmd_id)
+        if setting is not None:
+            return await self._receiver.set_sound_settings(*setting)
+
+        return StatusCodes.NOT_IMPLEMENTED
 
     def filter_changed_attributes(self, update: dict[str, Any]) -> dict[str, Any]:
         """
@@ -130,56 +181,48 @@ class SonyMediaPlayer(MediaPlayer):
         :return: filtered entity attributes containing changed attributes only.
         """
         attributes = {}
-
-        if Attributes.STATE in update:
-            state = update[Attributes.STATE]
-            attributes = self._key_update_helper(Attributes.STATE, state, attributes)
-
-        for attr in [
-            Attributes.MEDIA_ARTIST,
-            Attributes.MEDIA_ALBUM,
-            Attributes.MEDIA_IMAGE_URL,
-            Attributes.MEDIA_TITLE,
-            Attributes.MUTED,
-            Attributes.SOURCE,
-            Attributes.SOURCE,
-            Attributes.VOLUME,
-        ]:
-            if attr in update:
-                attributes = self._key_update_helper(attr, update[attr], attributes)
-
-        if Attributes.SOURCE_LIST in update:
-            if Attributes.SOURCE_LIST in self.attributes:
-                if update[Attributes.SOURCE_LIST] != self.attributes[Attributes.SOURCE_LIST]:
-                    attributes[Attributes.SOURCE_LIST] = update[Attributes.SOURCE_LIST]
-
-        if Features.SELECT_SOUND_MODE in self.features:
-            if Attributes.SOUND_MODE in update:
-                attributes = self._key_update_helper(Attributes.SOUND_MODE, update[Attributes.SOUND_MODE], attributes)
-            if Attributes.SOUND_MODE_LIST in update:
-                if Attributes.SOUND_MODE_LIST in self.attributes:
-                    if update[Attributes.SOUND_MODE_LIST] != self.attributes[Attributes.SOUND_MODE_LIST]:
-                        attributes[Attributes.SOUND_MODE_LIST] = update[Attributes.SOUND_MODE_LIST]
-
-        if Attributes.STATE in attributes:
-            if attributes[Attributes.STATE] == States.OFF:
-                attributes[Attributes.MEDIA_IMAGE_URL] = ""
-                attributes[Attributes.MEDIA_ALBUM] = ""
-                attributes[Attributes.MEDIA_ARTIST] = ""
-                attributes[Attributes.MEDIA_TITLE] = ""
-                attributes[Attributes.MEDIA_TYPE] = ""
-                attributes[Attributes.SOURCE] = ""
-
-        return attributes
-
-    def _key_update_helper(self, key: str, value: str | None, attributes):
-        if value is None:
+        if not update:
+            return attributes
+        current_attributes = self.attributes
+
+        # Idle receivers repeat the same values: skip the comparison if nothing changed since the last update.
+        # The entity state is checked as well because the driver also sets it directly, e.g. on disconnection.
+        snapshot = tuple(update.get(key) for key in _SNAPSHOT_KEYS)
+        last_update = self._last_update
+        state = update.get(_A_STATE)
+        self._last_update = (snapshot, state if state is not None else current_attributes.get(_A_STATE))
+        if (
+            last_update is not None
+            and last_update[0] == snapshot
+            and last_update[1] == current_attributes.get(_A_STATE)
+            and update.keys().isdisjoint(_LIST_KEYS)
+        ):
             return attributes
 
-        if key in self.attributes:
-            if self.attributes[key] != value:
-                attributes[key] = value
-        else:
-            attributes[key] = value
+        # None values are not sent: the attribute is unknown or not yet available
+        for attr in self._SCALAR_ATTRS:
+            value = update.get(attr)
+            if value is not None and current_attributes.get(attr) != value:
+                attributes[attr] = value
+
+        # list attributes are mostly static: compare by identity first to avoid walking both lists
+        if _A_SOURCE_LIST in update and _A_SOURCE_LIST in current_attributes:
+            new = update[_A_SOURCE_LIST]
+            old = current_attributes[_A_SOURCE_LIST]
+            if new is not old and new != old:
+                attributes[_A_SOURCE_LIST] = new
+
+        if _F_SELECT_SOUND_MODE in self.features:
+            value = update.get(_A_SOUND_MODE)
+            if value is not None and current_attributes.get(_A_SOUND_MODE) != value:
+                attributes[_A_SOUND_MODE] = value
+            if _A_SOUND_MODE_LIST in update and _A_SOUND_MODE_LIST in current_attributes:
+                new = update[_A_SOUND_MODE_LIST]
+                old = current_attributes[_A_SOUND_MODE_LIST]
+                if new is not old and new != old:
+                    attributes[_A_SOUND_MODE_LIST] = new
+
+        if attributes.get(_A_STATE) is _S_OFF:
+            attributes.update(_OFF_CLEAR)
 
         return attributes
@@ -7,13 +7,20 @@ Setup flow for Sony AVR integration.
 
 import asyncio
 import logging
+import math
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
 from enum import IntEnum
-from urllib.parse import urlparse
+from typing import Awaitable, Callable
 
 import config
 import discover
-from config import AvrDevice
+from config import AvrDevice, extract_url
 from songpal import Device, SongpalException
+from songpal.containers import InterfaceInfo, Sysinfo
+from songpal.discovery import DiscoveredDevice
 from ucapi import (
     AbortDriverSetup,
     DriverSetupRequest,
@@ -38,13 +45,115 @@ class SetupSteps(IntEnum):
     DEVICE_CHOICE = 3
 
 
-DEFAULT_PORT = 10000
+def _setup_delay_from_env() -> float:
+    """
+    Return the web-configurator workaround delay configured with the UC_SETUP_DELAY environment variable.
+
+    :return: the delay in seconds, 1 if not set or invalid, negative values are clamped to 0
+    """
+    value = os.getenv("UC_SETUP_DELAY", "1")
+    try:
+        delay = float(value)
+    except ValueError:
+        delay = math.nan
+    if not math.isfinite(delay):
+        _LOG.warning("Invalid UC_SETUP_DELAY value '%s', using 1 second", value)
+        return 1.0
+    return max(delay, 0.0)
+
 
-_setup_step = SetupSteps.INIT
-_cfg_add_device: bool = False
+DEVICE_INFO_TTL = 60
+DISCOVERY_TTL = 30
+# The web-configurator does not pick up a response sent right after the configuration mode screen.
+# Remove this delay once the web-configurator handles immediate responses, set UC_SETUP_DELAY=0 to disable it.
+_WEBCONFIG_WORKAROUND_DELAY = _setup_delay_from_env()
+_DEVICE_INFO_CACHE_SIZE = 16
+
+
+@dataclass(slots=True)
+class SetupSession:
+    """State of the ongoing driver setup flow."""
+
+    step: SetupSteps = SetupSteps.INIT
+    add_device: bool = False
+
+
+_session = SetupSession()
+# Holds the (timestamp, discovered devices) of the last discovery, shared by setup sessions to avoid repeated SSDP scans
+_discovery_cache: list[tuple[float, list[DiscoveredDevice]]] = []
+# Map of normalized endpoint -> (timestamp, interface information, system information)
+_device_info_cache: OrderedDict[str, tuple[float, InterfaceInfo, Sysinfo]] = OrderedDict()
 # pylint: disable = C0301
 # flake8: noqa
 
+# TODO #12 externalize language texts
+# Constant setup screen elements, built once instead of on every setup request
+_ACTION_ADD = {
+    "id": "add",
+    "label": {
+        "en": "Add a new device",
+        "de": "Neues Gerät hinzufügen",
+        "fr": "Ajouter un nouvel appareil",
+    },
+}
+_ACTION_REMOVE = {
+    "id": "remove",
+    "label": {
+        "en": "Delete selected device",
+        "de": "Selektiertes Gerät löschen",
+        "fr": "Supprimer l'appareil sélectionné",
+    },
+}
+_ACTION_RESET = {
+    "id": "reset",
+    "label": {
+        "en": "Reset configuration and reconfigure",
+        "de": "Konfiguration zurücksetzen und neu konfigurieren",
+        "fr": "Réinitialiser la configuration et reconfigurer",
+    },
+}
+# remove & reset actions are only offered if there's at least one configured device
+_DEVICE_ACTIONS = (_ACTION_ADD, _ACTION_REMOVE, _ACTION_RESET)
+_NO_DEVICE_ACTIONS = (_ACTION_ADD,)
+_NO_DEVICE_ITEM = {"id": "", "label": {"en": "---"}}
+_CONFIGURATION_MODE_TITLE = {"en": "Configuration mode", "de": "Konfigurations-Modus"}
+_CONFIGURED_DEVICES_LABEL = {
+    "en": "Configured devices",
+    "de": "Konfigurierte Geräte",
+    "fr": "Appareils configurés",
+}
+_ACTION_LABEL = {
+    "en": "Action",
+    "de": "Aktion",
+    "fr": "Appareils configurés",
+}
+_DEVICE_CHOICE_TITLE = {
+    "en": "Please choose your Sony AVR",
+    "de": "Bitte Sony AVR auswählen",
+    "fr": "Sélectionnez votre ampli Sony",
+}
+_DEVICE_CHOICE_LABEL = {
+    "en": "Choose your Sony AVR",
+    "de": "Wähle deinen Sony AVR",
+    "fr": "Choisissez votre Sony AVR",
+}
+_ALWAYS_ON_FIELD = {
+    "id": "always_on",
+    "label": {
+        "en": "Keep connection alive (faster initialization, but consumes more battery)",
+        "fr": "Conserver la connexion active (lancement plus rapide, mais consomme plus de batterie)",
+    },
+    "field": {"checkbox": {"value": False}},
+}
+_VOLUME_STEP_FIELD = {
+    "id": "volume_step",
+    "label": {
+        "en": "Volume step",
+        "fr": "Pallier de volume",
+    },
+    "field": {"number": {"value": 2.0, "min": 0.5, "max": 10, "steps": 1, "decimals": 1, "unit": {"en": "dB"}}},
+}
+
 _user_input_discovery = RequestUserInput(
     {"en": "Setup mode", "de": "Setup Modus"},
     [
@@ -70,6 +179,73 @@ _user_input_discovery = RequestUserInput(
 )
 
 
+async def _get_device_info(host: str) -> tuple[InterfaceInfo, Sysinfo]:
+    """
+    Retrieve the interface and system information of the given device.
+
+    Results are cached for DEVICE_INFO_TTL seconds: the same device is probed in several setup steps.
+
+    :param host: normalized device endpoint
+    :return: interface and system information
+    :raises SongpalException: if the device cannot be queried
+    """
+    cached = _device_info_cache.get(host)
+    if cached and time.monotonic() - cached[0] < DEVICE_INFO_TTL:
+        _device_info_cache.move_to_end(host)
+        return cached[1], cached[2]
+    _device_info_cache.pop(host, None)
+
+    device = Device(host)
+    await device.get_supported_methods()
+    interface_info, system_info = await asyncio.gather(device.get_interface_information(), device.get_system_info())
+
+    _device_info_cache[host] = (time.monotonic(), interface_info, system_info)
+    if len(_device_info_cache) > _DEVICE_INFO_CACHE_SIZE:
+        _device_info_cache.popitem(last=False)
+    return interface_info, system_info
+
+
+def _parse_checkbox(raw) -> bool:
+    """
+    Parse the value of a checkbox input field.
+
+    :param raw: field value, either a boolean or its string representation
+    :return: True if the checkbox is checked
+    """
+    return raw is True or str(raw).lower() == "true"
+
+
+def _parse_volume_step(raw) -> float | None:
+    """
+    Parse the volume step entered by the user.
+
+    :param raw: value of the volume step input field
+    :return: the volume step, None if it is not a number between 0.1 and 10
+    """
+    try:
+        value = float(raw)
+    except (TypeError, ValueError):
+        return None
+    if not math.isfinite(value) or not 0.1 <= value <= 10:
+        return None
+    return value
+
+
+async def _probe(host: str) -> InterfaceInfo | None:
+    """
+    Check the connection to the given device.
+
+    :param host: normalized device endpoint
+    :return: the interface information, None if the device cannot be queried
+    """
+    try:
+        interface_info, _ = await _get_device_info(host)
+    except SongpalException as ex:
+        _LOG.warning("Cannot connect to %s: %s", host, ex)
+        return None
+    return interface_info
+
+
 async def driver_setup_handler(msg: SetupDriver) -> SetupAction:
     """
     Dispatch driver setup requests to corresponding handlers.
@@ -79,25 +255,20 @@ async def driver_setup_handler(msg: SetupDriver) -> SetupAction:
     :param msg: the setup driver request object, either DriverSetupRequest or UserDataResponse
     :return: the setup action on how to continue
     """
-    global _setup_step
-    global _cfg_add_device
+    global _session
 
     if isinstance(msg, DriverSetupRequest):
-        _setup_step = SetupSteps.INIT
-        _cfg_add_device = False
+        _session = SetupSession()
         return await handle_driver_setup(msg)
     if isinstance(msg, UserDataResponse):
         _LOG.debug(msg)
-        if _setup_step == SetupSteps.CONFIGURATION_MODE and "action" in msg.input_values:
-            return await handle_configuration_mode(msg)
-        if _setup_step == SetupSteps.DISCOVER and "address" in msg.input_values:
-            return await _handle_discovery(msg)
-        if _setup_step == SetupSteps.DEVICE_CHOICE and "choice" in msg.input_values:
-            return await handle_device_choice(msg)
+        step_handler = _STEP_HANDLERS.get(_session.step)
+        if step_handler is not None and step_handler[0] in msg.input_values:
+            return await step_handler[1](msg)
         _LOG.error("No or invalid user response was received: %s", msg)
     elif isinstance(msg, AbortDriverSetup):
         _LOG.info("Setup was aborted with code: %s", msg.error)
-        _setup_step = SetupSteps.INIT
+        _session = SetupSession()
 
     # user confirmation not used in setup process
     # if isinstance(msg, UserConfirmationResponse):
@@ -118,59 +289,26 @@ async def handle_driver_setup(
     :param _msg: not used, we don't have any input fields in the first setup screen.
     :return: the setup action on how to continue
     """
-    global _setup_step
-
     reconfigure = _msg.reconfigure
     _LOG.debug("Starting driver setup, reconfigure=%s", reconfigure)
     if reconfigure:
-        _setup_step = SetupSteps.CONFIGURATION_MODE
+        _session.step = SetupSteps.CONFIGURATION_MODE
 
         # get all configured devices for the user to choose from
-        dropdown_devices = []
-        for device in config.devices.all():
-            dropdown_devices.append({"id": device.id, "label": {"en": f"{device.name} ({device.id})"}})
-
-        # TODO #12 externalize language texts
-        # build user actions, based on available devices
-        dropdown_actions = [
-            {
-                "id": "add",
-                "label": {
-                    "en": "Add a new device",
-                    "de": "Neues Gerät hinzufügen",
-                    "fr": "Ajouter un nouvel appareil",
-                },
-            },
+        dropdown_devices = [
+            {"id": device.id, "label": {"en": f"{device.name} ({device.id})"}} for device in config.devices.all()
         ]
 
-        # add remove & reset actions if there's at least one configured device
+        # build user actions, based on available devices
         if dropdown_devices:
-            dropdown_actions.append(
-                {
-                    "id": "remove",
-                    "label": {
-                        "en": "Delete selected device",
-                        "de": "Selektiertes Gerät löschen",
-                        "fr": "Supprimer l'appareil sélectionné",
-                    },
-                },
-            )
-            dropdown_actions.append(
-                {
-                    "id": "reset",
-                    "label": {
-                        "en": "Reset configuration and reconfigure",
-                        "de": "Konfiguration zurücksetzen und neu konfigurieren",
-                        "fr": "Réinitialiser la configuration et reconfigurer",
-                    },
-                },
-            )
+            dropdown_actions = _DEVICE_ACTIONS
         else:
+            dropdown_actions = _NO_DEVICE_ACTIONS
             # dummy entry if no devices are available
-            dropdown_devices.append({"id": "", "label": {"en": "---"}})
+            dropdown_devices.append(_NO_DEVICE_ITEM)
 
         return RequestUserInput(
-            {"en": "Configuration mode", "de": "Konfigurations-Modus"},
+            _CONFIGURATION_MODE_TITLE,
             [
                 {
                     "field": {
@@ -180,11 +318,7 @@ async def handle_driver_setup(
                         }
                     },
                     "id": "choice",
-                    "label": {
-                        "en": "Configured devices",
-                        "de": "Konfigurierte Geräte",
-                        "fr": "Appareils configurés",
-                    },
+                    "label": _CONFIGURED_DEVICES_LABEL,
                 },
                 {
                     "field": {
@@ -194,18 +328,14 @@ async def handle_driver_setup(
                         }
                     },
                     "id": "action",
-                    "label": {
-                        "en": "Action",
-                        "de": "Aktion",
-                        "fr": "Appareils configurés",
-                    },
+                    "label": _ACTION_LABEL,
                 },
             ],
         )
 
     # Initial setup, make sure we have a clean configuration
     config.devices.clear()  # triggers device instance removal
-    _setup_step = SetupSteps.DISCOVER
+    _session.step = SetupSteps.DISCOVER
     return _user_input_discovery
 
 
@@ -221,34 +351,50 @@ async def handle_configuration_mode(
     :param msg: response data from the requested user data
     :return: the setup action on how to continue
     """
-    global _setup_step
-    global _cfg_add_device
-
     action = msg.input_values["action"]
 
     # workaround for web-configurator not picking up first response
-    await asyncio.sleep(1)
-
-    match action:
-        case "add":
-            _cfg_add_device = True
-        case "remove":
-            choice = msg.input_values["choice"]
-            if not config.devices.remove(choice):
-                _LOG.warning("Could not remove device from configuration: %s", choice)
-                return SetupError(error_type=IntegrationSetupError.OTHER)
-            config.devices.store()
-            return SetupComplete()
-        case "reset":
-            config.devices.clear()  # triggers device instance removal
-        case _:
-            _LOG.error("Invalid configuration action: %s", action)
-            return SetupError(error_type=IntegrationSetupError.OTHER)
-
-    _setup_step = SetupSteps.DISCOVER
+    if _WEBCONFIG_WORKAROUND_DELAY > 0:
+        await asyncio.sleep(_WEBCONFIG_WORKAROUND_DELAY)
+
+    handler = _ACTION_HANDLERS.get(action)
+    if handler is None:
+        _LOG.error("Invalid configuration action: %s", action)
+        return SetupError(error_type=IntegrationSetupError.OTHER)
+    return await handler(msg)
+
+
+async def _action_add(_msg: UserDataResponse) -> RequestUserInput:
+    """Add a new device: continue with the discovery screen."""
+    _session.add_device = True
+    _session.step = SetupSteps.DISCOVER
     return _user_input_discovery
 
 
+async def _action_remove(msg: UserDataResponse) -> SetupComplete | SetupError:
+    """Remove the selected device from the configuration."""
+    choice = msg.input_values["choice"]
+    if not config.devices.remove(choice):
+        _LOG.warning("Could not remove device from configuration: %s", choice)
+        return SetupError(error_type=IntegrationSetupError.OTHER)
+    await config.devices.astore()
+    return SetupComplete()
+
+
+async def _action_reset(_msg: UserDataResponse) -> RequestUserInput:
+    """Remove all devices and continue with the discovery screen."""
+    config.devices.clear()  # triggers device instance removal
+    _session.step = SetupSteps.DISCOVER
+    return _user_input_discovery
+
+
+_ACTION_HANDLERS: dict[str, Callable[[UserDataResponse], Awaitable[SetupAction]]] = {
+    "add": _action_add,
+    "remove": _action_remove,
+    "reset": _action_reset,
+}
+
+
 async def _handle_discovery(msg: UserDataResponse) -> RequestUserInput | SetupError:
     """
     Process user data response in a setup process.
@@ -259,61 +405,45 @@ async def _handle_discovery(msg: UserDataResponse) -> RequestUserInput | SetupEr
     :param msg: response data from the requested user data
     :return: the setup action on how to continue
     """
-    global _setup_step
-
-    dropdown_items = []
     address = msg.input_values["address"]
 
     if address:
         _LOG.debug("Starting manual driver setup for %s", address)
-        try:
-            if not address.startswith("http://"):
-                address = f"http://{address}"
-
-            result = urlparse(address)
-            path = result.path
-            port = result.port
-            if not path:
-                path = "/sony"
-            if not port:
-                port = DEFAULT_PORT
-            address = f"{result.scheme}://{result.hostname}:{port}{path}"
-
-            _LOG.debug("Formatted address : %s", address)
-            # simple connection check
-            device = Device(address)
-            await device.get_supported_methods()
-            interface_info = await device.get_interface_information()
-            dropdown_items.append(
-                {
-                    "id": address,
-                    "label": {"en": f"{interface_info.modelName} [{address}]"},
-                }
-            )
-        except SongpalException as ex:
-            _LOG.error("Cannot connect to manually entered address %s: %s", address, ex)
+        address = extract_url(address)
+        _LOG.debug("Formatted address : %s", address)
+        # simple connection check
+        interface_info = await _probe(address)
+        if interface_info is None:
+            _LOG.error("Cannot connect to manually entered address %s", address)
             return SetupError(error_type=IntegrationSetupError.CONNECTION_REFUSED)
+        dropdown_items = [{"id": address, "label": {"en": f"{interface_info.modelName} [{address}]"}}]
     else:
         _LOG.debug("Starting auto-discovery driver setup")
-        avrs = await discover.sony_avrs()
-        for a in avrs:
-            avr_data = {
-                "id": a.endpoint,
-                "label": {"en": f"{a.name} ({a.model_number}) [{a.endpoint}]"},
-            }
-            dropdown_items.append(avr_data)
+        now = time.monotonic()
+        if _discovery_cache and now - _discovery_cache[0][0] < DISCOVERY_TTL:
+            avrs = _discovery_cache[0][1]
+        else:
+            avrs = await discover.sony_avrs()
+            # don't remember an empty result: the user may retry after powering on the device
+            if avrs:
+                _discovery_cache[:] = [(now, avrs)]
+        endpoints = [extract_url(a.endpoint) for a in avrs]
+        # probe all discovered devices concurrently, this also fills the device information cache used by
+        # handle_device_choice. A device failing unexpectedly must not hide the other ones.
+        results = await asyncio.gather(*(_probe(endpoint) for endpoint in endpoints), return_exceptions=True)
+        dropdown_items = [
+            {"id": endpoint, "label": {"en": f"{a.name} ({a.model_number}) [{a.endpoint}]"}}
+            for a, endpoint, result in zip(avrs, endpoints, results)
+            if isinstance(result, InterfaceInfo)
+        ]
 
     if not dropdown_items:
         _LOG.warning("No AVRs found")
         return SetupError(error_type=IntegrationSetupError.NOT_FOUND)
 
-    _setup_step = SetupSteps.DEVICE_CHOICE
+    _session.step = SetupSteps.DEVICE_CHOICE
     return RequestUserInput(
-        {
-            "en": "Please choose your Sony AVR",
-            "de": "Bitte Sony AVR auswählen",
-            "fr": "Sélectionnez votre ampli Sony",
-        },
+        _DEVICE_CHOICE_TITLE,
         [
             {
                 "field": {
@@ -323,30 +453,10 @@ async def _handle_discovery(msg: UserDataResponse) -> RequestUserInput | SetupEr
                     }
                 },
                 "id": "choice",
-                "label": {
-                    "en": "Choose your Sony AVR",
-                    "de": "Wähle deinen Sony AVR",
-                    "fr": "Choisissez votre Sony AVR",
-                },
-            },
-            {
-                "id": "always_on",
-                "label": {
-                    "en": "Keep connection alive (faster initialization, but consumes more battery)",
-                    "fr": "Conserver la connexion active (lancement plus rapide, mais consomme plus de batterie)",
-                },
-                "field": {"checkbox": {"value": False}},
-            },
-            {
-                "id": "volume_step",
-                "label": {
-                    "en": "Volume step",
-                    "fr": "Pallier de volume",
-                },
-                "field": {
-                    "number": {"value": 2.0, "min": 0.5, "max": 10, "steps": 1, "decimals": 1, "unit": {"en": "dB"}}
-                },
+                "label": _DEVICE_CHOICE_LABEL,
             },
+            _ALWAYS_ON_FIELD,
+            _VOLUME_STEP_FIELD,
         ],
     )
 
@@ -361,41 +471,23 @@ async def handle_device_choice(msg: UserDataResponse) -> SetupComplete | SetupEr
     :return: the setup action on how to continue: SetupComplete if a valid AVR device was chosen.
     """
     host = msg.input_values["choice"]
-    always_on = msg.input_values.get("always_on") == "true"
-    volume_step = 2
-    try:
-        volume_step = float(msg.input_values.get("volume_step", 0.5))
-        if volume_step < 0.1 or volume_step > 10:
-            return SetupError(error_type=IntegrationSetupError.OTHER)
-    except ValueError:
+    always_on = _parse_checkbox(msg.input_values.get("always_on"))
+    volume_step = _parse_volume_step(msg.input_values.get("volume_step", 0.5))
+    if volume_step is None:
         return SetupError(error_type=IntegrationSetupError.OTHER)
     _LOG.debug(
         "Chosen Sony AVR: %s. Trying to connect and retrieve device information...",
         host,
     )
     try:
-        if not host.startswith("http://"):
-            host = f"http://{host}"
-
-        result = urlparse(host)
-        path = result.path
-        port = result.port
-        if not path:
-            path = "/sony"
-        if not port:
-            port = DEFAULT_PORT
-        host = f"{result.scheme}://{result.hostname}:{port}{path}"
+        host = extract_url(host)
 
         # simple connection check
-        device = Device(host)
-        await device.get_supported_methods()
-        interface_info = await device.get_interface_information()
-        system_info = await device.get_system_info()
+        interface_info, system_info = await _get_device_info(host)
     except SongpalException as ex:
         _LOG.error("Cannot connect to %s: %s", host, ex)
         return SetupError(error_type=IntegrationSetupError.CONNECTION_REFUSED)
 
-    assert device
     assert system_info
 
     unique_id = system_info.serialNumber
@@ -420,11 +512,18 @@ async def handle_device_choice(msg: UserDataResponse) -> SetupComplete | SetupEr
             volume_step=volume_step
         )
     )  # triggers SonyAVR instance creation
-    config.devices.store()
+    await config.devices.astore()
+    _device_info_cache.pop(host, None)
 
     # AVR device connection will be triggered with subscribe_entities request
 
-    await asyncio.sleep(1)
-
     _LOG.info("Setup successfully completed for %s (%s)", interface_info.modelName, unique_id)
     return SetupComplete()
+
+
+# setup step -> (required user input field, handler of the user data response)
+_STEP_HANDLERS: dict[SetupSteps, tuple[str, Callable[[UserDataResponse], Awaitable[SetupAction]]]] = {
+    SetupSteps.CONFIGURATION_MODE: ("action", handle_configuration_mode),
+    SetupSteps.DISCOVER: ("address", _handle_discovery),
+    SetupSteps.DEVICE_CHOICE: ("choice", handle_device_choice),
+}